@@ -0,0 +1,155 @@
+"""
+Measure how long it takes to build, render and deploy the contrib component
+trees. Components are attached to a fake host that records commands instead
+of running them, so no remote access is needed.
+
+    python -m benchmarks.components [--apps N] [--rounds N]
+"""
+
+import argparse
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from opslib import Command, File, LocalHost, Stack, evaluate, lazy_property
+from opslib.components import walk
+from opslib.results import Result
+
+from opslib_contrib.backup_service import BackupService, BackupStorage
+from opslib_contrib.docker import DockerComposePrepull, DockerComposeUp
+from opslib_contrib.healthchecks import Healthchecks
+from opslib_contrib.home_assistant import HomeAssistant
+from opslib_contrib.localsecret import LocalSecret
+from opslib_contrib.paperless import Paperless
+
+
+class FakeRunResult(Result):
+    stdout = ""
+    stderr = ""
+
+
+class FakeHost(LocalHost):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.commands = []
+
+    def run(self, *args, **kwargs):
+        self.commands.append((args, kwargs.get("input")))
+        return FakeRunResult(changed=True)
+
+
+class FakeStorage(BackupStorage):
+    @lazy_property
+    def restic_repository(self):
+        return "/srv/restic"
+
+    @lazy_property
+    def restic_env(self):
+        return {}
+
+
+def create_stack(stateroot, apps):
+    class BenchmarkStack(Stack):
+        def build(self):
+            self.host = FakeHost()
+            directory = self.host.directory("/opt/apps")
+            volumes = self.host.directory("/opt/volumes")
+
+            self.healthchecks = Healthchecks(api_key="benchmark")
+            self.backup_service = BackupService(
+                name_prefix="benchmark-",
+                healthchecks=self.healthchecks,
+            )
+
+            for n in range(apps):
+                paperless = Paperless(
+                    directory=directory / f"paperless{n}",
+                    volumes=volumes / f"paperless{n}",
+                )
+                setattr(self, f"paperless{n}", paperless)
+
+                home_assistant = HomeAssistant(
+                    directory=directory / f"home-assistant{n}",
+                    volumes=volumes / f"home-assistant{n}",
+                )
+                setattr(self, f"home_assistant{n}", home_assistant)
+
+                plan = self.backup_service.create_plan(
+                    name=f"plan{n}",
+                    directory=directory / f"backups{n}",
+                    storage=FakeStorage(),
+                    setup_healthcheck=False,
+                )
+                setattr(self, f"backup_plan{n}", plan)
+
+                paperless.backup_to(plan)
+                home_assistant.backup_to(plan)
+
+    return BenchmarkStack(stateroot=Path(stateroot))
+
+
+def components_of_type(stack, *types):
+    return [c for c in walk(stack) if isinstance(c, types)]
+
+
+@contextmanager
+def timer(timings, name):
+    t0 = time.perf_counter()
+    yield
+    timings[name] = timings.get(name, 0) + time.perf_counter() - t0
+
+
+def measure(stateroot, apps, timings):
+    with timer(timings, "build"):
+        stack = create_stack(stateroot, apps)
+
+    for secret in components_of_type(stack, LocalSecret):
+        secret.deploy(dry_run=False)
+
+    plans = [getattr(stack, f"backup_plan{n}") for n in range(apps)]
+    with timer(timings, "render scripts"):
+        for plan in plans:
+            evaluate(plan.backup_script_content)
+            evaluate(plan.daily_content)
+
+    with timer(timings, "evaluate files"):
+        for file in components_of_type(stack, File):
+            evaluate(file.props.content)
+
+    commands = components_of_type(stack, Command, DockerComposeUp, DockerComposePrepull)
+    with timer(timings, "deploy commands"):
+        # Like a first deploy, where every file is new and triggers its commands
+        for file in components_of_type(stack, File):
+            file.on_change.invoke()
+        for command in commands:
+            evaluate(command.deploy(dry_run=False))
+
+    return len(commands), len(stack.host.commands)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--apps", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=5)
+    options = parser.parse_args()
+
+    cold = {}
+    warm = {}
+    for _ in range(options.rounds):
+        with TemporaryDirectory() as tmp:
+            counts = measure(tmp, options.apps, cold)
+            # Same state directory again, with render caches populated
+            measure(tmp, options.apps, warm)
+
+    print(f"{options.apps} x (Paperless, HomeAssistant, BackupPlan)")
+    print(f"  command components: {counts[0]}")
+    print(f"  commands run on host by a deploy: {counts[1]}")
+    for label, timings in [("cold", cold), ("warm", warm)]:
+        print(f"  {label}:")
+        for name, elapsed in timings.items():
+            print(f"    {name:<16} {elapsed / options.rounds * 1000:10.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Compare render time of the compose file serializers on synthetic stacks.
+
+    python -m benchmarks.serialize
+"""
+
+import timeit
+
+import yaml
+
+from opslib_contrib.serialize import SERIALIZERS
+
+
+def synthetic_services(count):
+    return {
+        f"service{n}": {
+            "image": f"docker.io/library/app{n}:1.{n}",
+            "restart": "unless-stopped",
+            "depends_on": [f"service{n - 1}"] if n else [],
+            "volumes": [
+                f"/opt/volumes/app{n}/data:/data",
+                f"/opt/volumes/app{n}/config:/config",
+            ],
+            "environment": {
+                "DB_HOST": "db",
+                "DB_PASSWORD": "$DB_PASSWORD",
+                "WORKERS": n % 8 + 1,
+            },
+        }
+        for n in range(count)
+    }
+
+
+def main():
+    serializers = {
+        "yaml (pure python)": lambda data: yaml.dump(data, sort_keys=False),
+        **{
+            name: lambda data, func=func: func(data, sort_keys=False)
+            for name, func in SERIALIZERS.items()
+        },
+    }
+
+    for count in [10, 100, 1000]:
+        compose = {"services": synthetic_services(count)}
+        number = max(1, 1000 // count)
+        print(f"{count} services:")
+        for name, func in serializers.items():
+            elapsed = timeit.timeit(lambda: func(compose), number=number) / number
+            print(f"  {name:<20} {elapsed * 1000:10.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
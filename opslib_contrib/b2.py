@@ -0,0 +1,583 @@
+import hashlib
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+AUTHORIZE_URL = "https://api.backblazeb2.com/b2api/v2/b2_authorize_account"
+RETRY_STATUS = {408, 429, 500, 503}
+EXPIRED_AUTH = {"expired_auth_token", "bad_auth_token"}
+MAX_RETRIES = 8
+TIMEOUT = (10, 600)
+
+
+class B2Error(Exception):
+    def __init__(self, status, code, message):
+        super().__init__(f"{status} {code}: {message}")
+        self.status = status
+        self.code = code
+
+    @classmethod
+    def from_response(cls, resp):
+        try:
+            body = resp.json()
+        except ValueError:
+            body = {}
+        return cls(
+            resp.status_code,
+            body.get("code", "unknown"),
+            body.get("message", resp.text),
+        )
+
+
+def error_code(resp):
+    try:
+        return resp.json().get("code")
+    except ValueError:
+        return None
+
+
+def backoff(attempt, retry_after=None):
+    if retry_after:
+        return float(retry_after)
+    return min(64, 2**attempt) * random.uniform(0.5, 1)
+
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class B2Client:
+    # Safe to share between threads: one pooled session, one cached token.
+    # Large file parts are read into memory, so no more than
+    # `max_part_uploads` are in flight across all uploads; the connection pool
+    # has room for those on top of `max_connections` callers.
+    def __init__(self, key_id, key, max_connections=32, max_part_uploads=8):
+        self.key_id = key_id
+        self.key = key
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=max_connections + max_part_uploads,
+        )
+        self.session.mount("https://", adapter)
+        self._part_slots = threading.BoundedSemaphore(max_part_uploads)
+        self._auth = None
+        self._auth_lock = threading.Lock()
+        self._upload_urls = {}
+        self._upload_urls_lock = threading.Lock()
+        self._bucket_ids = {}
+
+    def authorize(self, stale=None):
+        with self._auth_lock:
+            if self._auth is None or self._auth is stale:
+                resp = self.session.get(
+                    AUTHORIZE_URL,
+                    auth=(self.key_id, self.key),
+                    timeout=TIMEOUT,
+                )
+                if not resp.ok:
+                    raise B2Error.from_response(resp)
+                self._auth = resp.json()
+            return self._auth
+
+    @property
+    def account_id(self):
+        return self.authorize()["accountId"]
+
+    @property
+    def part_size(self):
+        return self.authorize()["recommendedPartSize"]
+
+    def _with_retries(self, send):
+        attempt = 0
+        while True:
+            auth = self.authorize()
+            retry_after = None
+            try:
+                resp = send(auth)
+
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= MAX_RETRIES:
+                    raise
+
+            else:
+                if resp.ok:
+                    return resp
+
+                if attempt >= MAX_RETRIES:
+                    raise B2Error.from_response(resp)
+
+                if resp.status_code == 401 and error_code(resp) in EXPIRED_AUTH:
+                    self.authorize(stale=auth)
+                    attempt += 1
+                    continue
+
+                if resp.status_code not in RETRY_STATUS:
+                    raise B2Error.from_response(resp)
+
+                retry_after = resp.headers.get("Retry-After")
+
+            time.sleep(backoff(attempt, retry_after))
+            attempt += 1
+
+    def call(self, name, **params):
+        def send(auth):
+            return self.session.post(
+                f"{auth['apiUrl']}/b2api/v2/{name}",
+                headers={"Authorization": auth["authorizationToken"]},
+                json=params,
+                timeout=TIMEOUT,
+            )
+
+        return self._with_retries(send).json()
+
+    def list_buckets(self):
+        return self.call("b2_list_buckets", accountId=self.account_id)["buckets"]
+
+    def bucket_id(self, bucket_name):
+        if bucket_name not in self._bucket_ids:
+            buckets = self.call(
+                "b2_list_buckets",
+                accountId=self.account_id,
+                bucketName=bucket_name,
+            )["buckets"]
+            if not buckets:
+                raise B2Error(404, "not_found", f"Bucket {bucket_name!r} not found")
+            self._bucket_ids[bucket_name] = buckets[0]["bucketId"]
+        return self._bucket_ids[bucket_name]
+
+    def update_bucket(self, bucket_name, **params):
+        return self.call(
+            "b2_update_bucket",
+            accountId=self.account_id,
+            bucketId=self.bucket_id(bucket_name),
+            **params,
+        )
+
+    def list_file_names(self, bucket_name, prefix="", page_size=1000):
+        params = dict(
+            bucketId=self.bucket_id(bucket_name),
+            prefix=prefix,
+            maxFileCount=page_size,
+        )
+        while True:
+            page = self.call("b2_list_file_names", **params)
+            yield from page["files"]
+            if page["nextFileName"] is None:
+                return
+            params["startFileName"] = page["nextFileName"]
+
+    def list_file_versions(self, bucket_name, prefix="", page_size=1000):
+        params = dict(
+            bucketId=self.bucket_id(bucket_name),
+            prefix=prefix,
+            maxFileCount=page_size,
+        )
+        while True:
+            page = self.call("b2_list_file_versions", **params)
+            yield from page["files"]
+            if page["nextFileName"] is None:
+                return
+            params["startFileName"] = page["nextFileName"]
+            params["startFileId"] = page["nextFileId"]
+
+    def delete_file_version(self, file_name, file_id):
+        return self.call("b2_delete_file_version", fileName=file_name, fileId=file_id)
+
+    def _take_upload_url(self, key, get_url):
+        # Each upload URL accepts one upload at a time, so they are checked
+        # out of a pool and only returned after a successful upload.
+        with self._upload_urls_lock:
+            pool = self._upload_urls.setdefault(key, [])
+            if pool:
+                return pool.pop()
+        resp = get_url()
+        return resp["uploadUrl"], resp["authorizationToken"]
+
+    def _return_upload_url(self, key, upload_url):
+        with self._upload_urls_lock:
+            self._upload_urls.setdefault(key, []).append(upload_url)
+
+    def _upload(self, key, get_url, headers, data):
+        def send(auth):
+            upload_url = self._take_upload_url(key, get_url)
+            url, token = upload_url
+            if hasattr(data, "seek"):
+                data.seek(0)
+            resp = self.session.post(
+                url,
+                headers={"Authorization": token, **headers},
+                data=data,
+                timeout=TIMEOUT,
+            )
+            if resp.ok:
+                self._return_upload_url(key, upload_url)
+            return resp
+
+        return self._with_retries(send).json()
+
+    def upload_file(self, bucket_name, file_name, path, sha1=None, part_workers=4):
+        path = Path(path)
+        stat = path.stat()
+        bucket_id = self.bucket_id(bucket_name)
+        sha1 = sha1 or file_sha1(path)
+        info = {"src_last_modified_millis": str(stat.st_mtime_ns // 1_000_000)}
+
+        if stat.st_size > 2 * self.part_size:
+            info["large_file_sha1"] = sha1
+            return self._upload_large_file(
+                bucket_id, file_name, path, stat.st_size, info, part_workers
+            )
+
+        headers = {
+            "X-Bz-File-Name": quote(file_name, safe="/"),
+            "Content-Type": "b2/x-auto",
+            "Content-Length": str(stat.st_size),
+            "X-Bz-Content-Sha1": sha1,
+        }
+        for name, value in info.items():
+            headers[f"X-Bz-Info-{name}"] = quote(value)
+
+        with path.open("rb") as f:
+            return self._upload(
+                bucket_id,
+                lambda: self.call("b2_get_upload_url", bucketId=bucket_id),
+                headers,
+                f,
+            )
+
+    def _upload_large_file(self, bucket_id, file_name, path, size, info, workers):
+        file_id = self.call(
+            "b2_start_large_file",
+            bucketId=bucket_id,
+            fileName=file_name,
+            contentType="b2/x-auto",
+            fileInfo=info,
+        )["fileId"]
+        part_size = self.part_size
+
+        def upload_part(number):
+            with self._part_slots:
+                with path.open("rb") as f:
+                    f.seek((number - 1) * part_size)
+                    data = f.read(part_size)
+                sha1 = hashlib.sha1(data).hexdigest()
+                self._upload(
+                    file_id,
+                    lambda: self.call("b2_get_upload_part_url", fileId=file_id),
+                    {
+                        "X-Bz-Part-Number": str(number),
+                        "Content-Length": str(len(data)),
+                        "X-Bz-Content-Sha1": sha1,
+                    },
+                    data,
+                )
+                return sha1
+
+        try:
+            with ThreadPoolExecutor(workers) as pool:
+                parts = range(1, math.ceil(size / part_size) + 1)
+                sha1s = list(pool.map(upload_part, parts))
+
+        except BaseException:
+            self.call("b2_cancel_large_file", fileId=file_id)
+            raise
+
+        finally:
+            with self._upload_urls_lock:
+                self._upload_urls.pop(file_id, None)
+
+        return self.call(
+            "b2_finish_large_file",
+            fileId=file_id,
+            partSha1Array=sha1s,
+        )
+
+    def download_file(self, bucket_name, file_name, path):
+        path = Path(path)
+
+        def send(auth):
+            return self.session.get(
+                f"{auth['downloadUrl']}/file/{bucket_name}/{quote(file_name)}",
+                headers={"Authorization": auth["authorizationToken"]},
+                stream=True,
+                timeout=TIMEOUT,
+            )
+
+        resp = self._with_retries(send)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.b2tmp")
+        with resp, tmp.open("wb") as f:
+            for chunk in resp.iter_content(1 << 20):
+                f.write(chunk)
+
+        os.replace(tmp, path)
+        mtime = resp.headers.get("X-Bz-Info-src_last_modified_millis")
+        if mtime:
+            os.utime(path, ns=(time.time_ns(), int(mtime) * 1_000_000))
+
+
+def remote_sha1(file):
+    sha1 = file.get("contentSha1") or "none"
+    if sha1 == "none":
+        # Large files only have a checksum if the uploader recorded one
+        return file["fileInfo"].get("large_file_sha1")
+    return sha1.removeprefix("unverified:")
+
+
+class SyncIndex:
+    # (size, mtime, sha1) of each file per location, local directory or
+    # bucket prefix, updated as each file is transferred. A bucket listing is
+    # only reused to resume a sync that didn't complete.
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                " location TEXT, path TEXT, size INTEGER, mtime INTEGER, sha1 TEXT,"
+                " PRIMARY KEY (location, path))"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS remote_listings ("
+                " location TEXT PRIMARY KEY, listed_at REAL, complete INTEGER)"
+            )
+
+    def files(self, location):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT path, size, mtime, sha1 FROM files WHERE location = ?",
+                (location,),
+            ).fetchall()
+        return {path: (size, mtime, sha1) for path, size, mtime, sha1 in rows}
+
+    def is_interrupted(self, location):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT complete FROM remote_listings WHERE location = ?",
+                (location,),
+            ).fetchone()
+        return row is not None and not row[0]
+
+    def mark_complete(self, location):
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE remote_listings SET complete = 1 WHERE location = ?",
+                (location,),
+            )
+
+    def forget_bucket(self, bucket_name):
+        prefix = f"b2://{bucket_name}/"
+        with self.lock, self.db:
+            for table in ["files", "remote_listings"]:
+                self.db.execute(
+                    f"DELETE FROM {table} WHERE substr(location, 1, ?) = ?",
+                    (len(prefix), prefix),
+                )
+
+    def replace(self, location, files):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM files WHERE location = ?", (location,))
+            self.db.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+                [(location, path, *entry) for path, entry in files.items()],
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO remote_listings VALUES (?, ?, 0)",
+                (location, time.time()),
+            )
+
+    def update(self, location, path, size, mtime, sha1):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                (location, path, size, mtime, sha1),
+            )
+
+    def local_files(self, root):
+        root = Path(root)
+        location = str(root.resolve())
+        known = self.files(location)
+        files = {}
+        for path, size, mtime in local_files(root):
+            entry = known.get(path)
+            # Only hash files that are new or changed since the last walk
+            if entry is None or entry[:2] != (size, mtime):
+                entry = (size, mtime, file_sha1(root / path))
+                self.update(location, path, *entry)
+            files[path] = entry
+        return files
+
+    def remote_files(self, client, bucket_name, prefix="", relist=False):
+        location = f"b2://{bucket_name}/{prefix}"
+        if relist or not self.is_interrupted(location):
+            files = {
+                file["fileName"][len(prefix) :]: (
+                    file["contentLength"],
+                    remote_mtime(file),
+                    remote_sha1(file),
+                )
+                for file in client.list_file_names(bucket_name, prefix=prefix)
+                if file["action"] == "upload"
+            }
+            self.replace(location, files)
+            return files
+        return self.files(location)
+
+
+def remote_mtime(file):
+    info = file["fileInfo"]
+    return int(info.get("src_last_modified_millis", file["uploadTimestamp"]))
+
+
+def local_files(root):
+    root = Path(root)
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = Path(dirpath) / filename
+            if not path.is_file():
+                continue
+            stat = path.stat()
+            name = path.relative_to(root).as_posix()
+            yield name, stat.st_size, stat.st_mtime_ns // 1_000_000
+
+
+def needs_transfer(source, target):
+    if target is None:
+        return True
+    if source[2] and target[2]:
+        return source[2] != target[2]
+    return source[:2] != target[:2]
+
+
+def run_parallel(fn, items, max_workers):
+    with ThreadPoolExecutor(max_workers) as pool:
+        futures = [pool.submit(fn, item) for item in items]
+        try:
+            for future in as_completed(futures):
+                future.result()
+
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    return len(futures)
+
+
+def sync_to_bucket(
+    client,
+    index,
+    source,
+    bucket_name,
+    prefix="",
+    relist=False,
+    max_workers=16,
+    progress=None,
+):
+    source = Path(source)
+    location = f"b2://{bucket_name}/{prefix}"
+    remote = index.remote_files(client, bucket_name, prefix, relist=relist)
+    todo = [
+        (name, entry)
+        for name, entry in index.local_files(source).items()
+        if needs_transfer(entry, remote.get(name))
+    ]
+
+    def upload(item):
+        name, (size, mtime, sha1) = item
+        client.upload_file(bucket_name, prefix + name, source / name, sha1=sha1)
+        index.update(location, name, size, mtime, sha1)
+        if progress:
+            progress("upload", name)
+
+    count = run_parallel(upload, todo, max_workers)
+    index.mark_complete(location)
+    return count
+
+
+def sync_from_bucket(
+    client,
+    index,
+    bucket_name,
+    target,
+    prefix="",
+    relist=False,
+    max_workers=16,
+    progress=None,
+):
+    target = Path(target)
+    target.mkdir(parents=True, exist_ok=True)
+    location = str(target.resolve())
+    remote_location = f"b2://{bucket_name}/{prefix}"
+    local = index.local_files(target)
+    todo = [
+        (name, entry)
+        for name, entry in index.remote_files(
+            client, bucket_name, prefix, relist=relist
+        ).items()
+        if needs_transfer(entry, local.get(name))
+    ]
+
+    def download(item):
+        name, (size, mtime, sha1) = item
+        client.download_file(bucket_name, prefix + name, target / name)
+        index.update(location, name, size, mtime, sha1)
+        if progress:
+            progress("download", name)
+
+    count = run_parallel(download, todo, max_workers)
+    index.mark_complete(remote_location)
+    return count
+
+
+def delete_file_versions(client, bucket_name, prefix="", max_workers=32, progress=None):
+    t0 = time.monotonic()
+    # Bound the versions in flight, so memory doesn't grow with the bucket
+    in_flight = threading.BoundedSemaphore(max_workers * 4)
+    lock = threading.Lock()
+    errors = []
+    deleted = 0
+
+    def delete(file):
+        nonlocal deleted
+        try:
+            client.delete_file_version(file["fileName"], file["fileId"])
+            with lock:
+                deleted += 1
+                count = deleted
+            if progress:
+                progress(count, time.monotonic() - t0)
+
+        except Exception as error:
+            errors.append(error)
+
+        finally:
+            in_flight.release()
+
+    with ThreadPoolExecutor(max_workers) as pool:
+        versions = client.list_file_versions(bucket_name, prefix, page_size=10000)
+        for file in versions:
+            if errors:
+                break
+            in_flight.acquire()
+            pool.submit(delete, file)
+
+    if errors:
+        raise errors[0]
+
+    return deleted
@@ -1,13 +1,23 @@
 from functools import cached_property
 import os
-from tempfile import TemporaryDirectory
-from dataclasses import dataclass
+import time
+from dataclasses import dataclass, field
 import click
 
 from opslib import MaybeLazy, run
 from opslib.components import TypedComponent
+from opslib.state import StatefulMixin
 from opslib.terraform import TerraformProvider
 
+from .b2 import (
+    B2Client,
+    SyncIndex,
+    delete_file_versions,
+    sync_from_bucket,
+    sync_to_bucket,
+)
+from .terraform import TerraformWorkspace
+
 B2_KEY_CAPABILITIES = [
     "deleteFiles",
     "listBuckets",
@@ -23,9 +33,34 @@ B2_KEY_CAPABILITIES = [
 ]
 
 
+@dataclass
+class LifecycleRule:
+    # Files under `file_name_prefix` get hidden, then their hidden versions
+    # deleted, after the given number of days
+    file_name_prefix: str = ""
+    days_from_hiding_to_deleting: int | None = None
+    days_from_uploading_to_hiding: int | None = None
+
+    def terraform_args(self):
+        args = dict(file_name_prefix=self.file_name_prefix)
+        if self.days_from_hiding_to_deleting is not None:
+            args["days_from_hiding_to_deleting"] = self.days_from_hiding_to_deleting
+        if self.days_from_uploading_to_hiding is not None:
+            args["days_from_uploading_to_hiding"] = self.days_from_uploading_to_hiding
+        return args
+
+    def api_args(self):
+        return {
+            "fileNamePrefix": self.file_name_prefix,
+            "daysFromHidingToDeleting": self.days_from_hiding_to_deleting,
+            "daysFromUploadingToHiding": self.days_from_uploading_to_hiding,
+        }
+
+
 @dataclass
 class BackblazeProps:
     config: dict | None = None
+    batch: bool = False
 
 
 class Backblaze(TypedComponent(BackblazeProps)):
@@ -34,17 +69,19 @@ class Backblaze(TypedComponent(BackblazeProps)):
         return self.props.config or {}
 
     def build(self):
-        self.provider = TerraformProvider(
+        provider_class = TerraformWorkspace if self.props.batch else TerraformProvider
+        self.provider = provider_class(
             name="b2",
             source="Backblaze/b2",
             version="~> 0.8.1",
             config=self.config,
         )
 
-    def bucket(self, name):
+    def bucket(self, name, **kwargs):
         return BackblazeBucket(
             account=self,
             name=name,
+            **kwargs,
         )
 
     @property
@@ -57,20 +94,28 @@ class Backblaze(TypedComponent(BackblazeProps)):
     def b2_key(self):
         return self.config.get("application_key") or os.environ["B2_APPLICATION_KEY"]
 
+    @cached_property
+    def client(self):
+        return B2Client(self.b2_key_id, self.b2_key)
+
 
 @dataclass
 class BackblazeBucketProps:
     account: Backblaze
     name: str
+    lifecycle_rules: list[LifecycleRule] = field(default_factory=list)
 
 
-class BackblazeBucket(TypedComponent(BackblazeBucketProps)):
+class BackblazeBucket(StatefulMixin, TypedComponent(BackblazeBucketProps)):
     def build(self):
         self.resource = self.props.account.provider.resource(
             type="b2_bucket",
             args=dict(
                 bucket_name=self.name,
                 bucket_type="allPrivate",
+                lifecycle_rules=[
+                    rule.terraform_args() for rule in self.props.lifecycle_rules
+                ],
             ),
             output=["bucket_id"],
         )
@@ -90,6 +135,10 @@ class BackblazeBucket(TypedComponent(BackblazeBucketProps)):
             bucket_id=self.bucket_id,
         )
 
+    @cached_property
+    def sync_index(self):
+        return SyncIndex(self._meta.statedir.path / "sync-index.sqlite3")
+
     def run(self, *args, **kwargs):
         extra_env = kwargs.setdefault("extra_env", {})
         extra_env.update(
@@ -103,34 +152,101 @@ class BackblazeBucket(TypedComponent(BackblazeBucketProps)):
         def run(args):
             self.run(*args, capture_output=False, exit=True)
 
+        def progress(action, name):
+            click.echo(f"{action}: {name}")
+
         @cli.command()
         @click.argument("source", type=click.Path(file_okay=False))
-        def sync_from(source):
-            b2_uri = f"b2://{self.props.name}"
-            self.run("sync", source, b2_uri, capture_output=False, exit=True)
+        @click.option("--workers", type=int, default=16)
+        @click.option(
+            "--relist",
+            is_flag=True,
+            help="List the bucket again instead of resuming an interrupted sync",
+        )
+        def sync_from(source, workers, relist):
+            count = sync_to_bucket(
+                self.props.account.client,
+                self.sync_index,
+                source,
+                self.name,
+                relist=relist,
+                max_workers=workers,
+                progress=progress,
+            )
+            click.echo(f"{count} files uploaded")
 
         @cli.command()
         @click.argument("target", type=click.Path(file_okay=False))
-        def sync_to(target):
-            b2_uri = f"b2://{self.props.name}"
-            self.run("sync", b2_uri, target, capture_output=False, exit=True)
+        @click.option("--workers", type=int, default=16)
+        @click.option(
+            "--relist",
+            is_flag=True,
+            help="List the bucket again instead of resuming an interrupted sync",
+        )
+        def sync_to(target, workers, relist):
+            count = sync_from_bucket(
+                self.props.account.client,
+                self.sync_index,
+                self.name,
+                target,
+                relist=relist,
+                max_workers=workers,
+                progress=progress,
+            )
+            click.echo(f"{count} files downloaded")
 
         @cli.command()
-        def empty_bucket():
+        @click.option("--workers", type=int, default=32)
+        @click.option(
+            "--lifecycle",
+            is_flag=True,
+            help="Install a lifecycle rule that lets B2 delete everything "
+            "within a couple of days, instead of deleting files now. It "
+            "replaces the bucket's lifecycle_rules until the next deploy.",
+        )
+        def empty_bucket(workers, lifecycle):
             b2_uri = f"b2://{self.props.name}"
             resp = input(f"Are you sure you want to empty the bucket {b2_uri!r}? [y/N]")
             if resp.lower() != "y":
                 return
-            with TemporaryDirectory() as tmp:
-                self.run(
-                    "sync",
-                    "--allow-empty-source",
-                    "--delete",
-                    tmp,
-                    b2_uri,
-                    capture_output=False,
-                    exit=True,
+
+            client = self.props.account.client
+            self.sync_index.forget_bucket(self.name)
+
+            if lifecycle:
+                client.update_bucket(
+                    self.name,
+                    lifecycleRules=[
+                        LifecycleRule(
+                            days_from_uploading_to_hiding=1,
+                            days_from_hiding_to_deleting=1,
+                        ).api_args(),
+                    ],
+                )
+                click.echo(f"Lifecycle rule installed on {b2_uri}")
+                click.echo(
+                    "Warning: this replaces the bucket's lifecycle_rules, "
+                    "and the next deploy reverts it",
+                    err=True,
                 )
+                return
+
+            def report(count, elapsed):
+                if count % 1000 == 0:
+                    click.echo(f"{count} versions deleted, {count / elapsed:.0f}/s")
+
+            t0 = time.monotonic()
+            count = delete_file_versions(
+                client,
+                self.name,
+                max_workers=workers,
+                progress=report,
+            )
+            elapsed = time.monotonic() - t0
+            click.echo(
+                f"{count} versions deleted in {elapsed:.1f}s "
+                f"({count / max(elapsed, 0.001):.0f}/s)"
+            )
 
 
 @dataclass
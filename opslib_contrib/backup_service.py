@@ -1,21 +1,116 @@
+import json
+import math
 import shlex
+import time
 from dataclasses import dataclass
 from functools import cached_property
 from io import StringIO
+from pathlib import Path
 
+import click
 from opslib import Directory, evaluate, lazy_property
 from opslib.components import TypedComponent
 from opslib.extras.systemd import SystemdTimerService
-from opslib_contrib.backblaze import Backblaze, BackblazeBucket, BackblazeKey
+from opslib.results import Result
+from opslib.state import JsonState, StatefulMixin
+from opslib_contrib.backblaze import (
+    Backblaze,
+    BackblazeBucket,
+    BackblazeKey,
+    LifecycleRule,
+)
 from opslib_contrib.healthchecks import Healthchecks
 from opslib_contrib.localsecret import LocalSecret
 from opslib_contrib.restic import Restic
+from opslib_contrib.snapshots import FilesystemSnapshot
 
 BASH_PREAMBLE = """\
 #!/bin/bash
 set -euo pipefail
 """
 
+PARALLEL_PRECOMMANDS_WAIT = """\
+precommand_failed=0
+for pid in "${precommand_pids[@]}"; do
+    wait "$pid" || precommand_failed=1
+done
+if [ "$precommand_failed" != 0 ]; then
+    echo "Backup pre-command failed" >&2
+    exit 1
+fi
+"""
+
+METRICS_REPORT_SCRIPT = """\
+import json, os, sys, time
+
+log_path, started_at, plan, summary_path, textfile_path = sys.argv[1:]
+keys = [
+    "files_new",
+    "files_changed",
+    "files_unmodified",
+    "data_added",
+    "total_bytes_processed",
+]
+summary = dict.fromkeys(keys, 0)
+with open(log_path) as f:
+    for line in f:
+        try:
+            message = json.loads(line)
+        except ValueError:
+            continue
+        if message.get("message_type") == "summary":
+            for key in keys:
+                summary[key] += message.get(key, 0)
+
+summary["finished_at"] = int(time.time())
+summary["duration"] = summary["finished_at"] - int(started_at)
+summary["throughput"] = summary["data_added"] / max(summary["duration"], 1)
+
+def write(path, content):
+    with open(f"{path}.tmp", "w") as f:
+        f.write(content)
+    os.replace(f"{path}.tmp", path)
+
+write(summary_path, json.dumps(summary, indent=2) + "\\n")
+
+if textfile_path:
+    metrics = [
+        ("restic_backup_files_new", summary["files_new"]),
+        ("restic_backup_files_changed", summary["files_changed"]),
+        ("restic_backup_files_unmodified", summary["files_unmodified"]),
+        ("restic_backup_data_added_bytes", summary["data_added"]),
+        ("restic_backup_processed_bytes", summary["total_bytes_processed"]),
+        ("restic_backup_duration_seconds", summary["duration"]),
+        ("restic_backup_throughput_bytes_per_second", summary["throughput"]),
+        ("restic_backup_last_success_timestamp_seconds", summary["finished_at"]),
+    ]
+    write(textfile_path, "".join(
+        f'{name}{{plan="{plan}"}} {value}\\n' for name, value in metrics
+    ))
+
+print(
+    f"Backup of {plan} took {summary['duration']}s, "
+    f"added {summary['data_added']} bytes "
+    f"({summary['throughput'] / 1e6:.2f} MB/s)"
+)
+"""
+
+BACKUP_LOCK_SCRIPT = """\
+acquire_backup_slot() {{
+    while true; do
+        for slot in $(seq 1 {slots}); do
+            exec 9> {lock_file}
+            if flock -n 9; then
+                return
+            fi
+        done
+        sleep 30
+    done
+}}
+acquire_backup_slot
+
+"""
+
 
 class BackupStorage:
     @lazy_property
@@ -32,18 +127,93 @@ class BackupServiceProps:
     name_prefix: str
     healthchecks: Healthchecks
     backblaze: Backblaze | None = None
+    schedule_start: str = "01:00"
+    default_backup_duration: int = 900
+    max_concurrent_backups: int | None = None
+    lock_directory: str = "/var/lock"
+    shared_repository: bool = False
+    restic_binary: str = "restic"
+    restic_initialized_ttl: int | None = None
+    b2_lifecycle_rules: list[LifecycleRule] | None = None
 
 
 class BackupService(TypedComponent(BackupServiceProps)):
+    def build(self):
+        self._schedule_lanes = {}
+
+        if self.props.shared_repository:
+            self.b2_bucket = self.props.backblaze.bucket(
+                name=self.full_name("shared"),
+                lifecycle_rules=self.b2_lifecycle_rules,
+            )
+
+            self.b2_key = self.b2_bucket.key()
+
+            storage = B2Storage(self.b2_bucket, self.b2_key)
+
+            self.password = LocalSecret()
+
+            self.repo = Restic(
+                repository=storage.restic_repository,
+                password=self.password.value,
+                env=storage.restic_env,
+                restic_binary=self.props.restic_binary,
+                initialized_ttl=self.props.restic_initialized_ttl,
+            )
+
+    @property
+    def b2_lifecycle_rules(self):
+        if self.props.b2_lifecycle_rules is None:
+            # Hidden file versions stay in the bucket, and get billed and
+            # listed, until a lifecycle rule removes them.
+            return [LifecycleRule(days_from_hiding_to_deleting=1)]
+        return self.props.b2_lifecycle_rules
+
     def create_plan(self, **kwargs):
         return BackupPlan(
             service=self,
             **kwargs,
         )
 
+    def maintenance(self, **props):
+        if not self.props.shared_repository:
+            raise ValueError(f"{self}: maintenance is per plan without shared mode")
+
+        return SharedResticMaintenance(
+            service=self,
+            **props,
+        )
+
     def full_name(self, name):
         return f"{self.props.name_prefix}{name}"
 
+    def schedule_slot(self, plan):
+        # Plans on the same host are laid out back to back, in as many lanes
+        # as backups are allowed to run concurrently, using the duration of
+        # their last run.
+        lanes = self._schedule_lanes.setdefault(
+            str(plan.directory.host),
+            [0] * (self.props.max_concurrent_backups or 1),
+        )
+        lane = min(range(len(lanes)), key=lanes.__getitem__)
+        offset = lanes[lane]
+        lanes[lane] += plan.expected_duration
+
+        hours, minutes = map(int, self.props.schedule_start.split(":"))
+        start = (hours * 60 + minutes + offset // 60) % (24 * 60)
+        return f"*-*-* {start // 60:02d}:{start % 60:02d}:00"
+
+    @property
+    def lock_script(self):
+        if self.props.max_concurrent_backups is None:
+            return ""
+
+        lock_prefix = Path(self.props.lock_directory) / self.props.name_prefix
+        return BACKUP_LOCK_SCRIPT.format(
+            slots=self.props.max_concurrent_backups,
+            lock_file=shlex.quote(f"{lock_prefix}backup-") + "$slot.lock",
+        )
+
 
 @dataclass
 class B2Storage(BackupStorage):
@@ -62,6 +232,58 @@ class B2Storage(BackupStorage):
         )
 
 
+@dataclass
+class ResticPerformance:
+    b2_connections: int | None = None
+    pack_size: int | None = None  # MiB
+    compression: str | None = None  # "auto", "off" or "max"; repository v2 only
+    read_concurrency: int | None = None
+    limit_upload: int | None = None  # KiB/s
+    nice: int | None = None
+    ionice_class: int | None = None
+    ionice_level: int | None = None
+
+    def wrapper(self):
+        cmd = []
+
+        if self.nice is not None:
+            cmd += ["nice", "-n", str(self.nice)]
+
+        if self.ionice_class is not None or self.ionice_level is not None:
+            cmd.append("ionice")
+            if self.ionice_class is not None:
+                cmd += ["-c", str(self.ionice_class)]
+            if self.ionice_level is not None:
+                cmd += ["-n", str(self.ionice_level)]
+
+        return cmd
+
+    def global_args(self):
+        args = []
+
+        if self.b2_connections is not None:
+            args.append(f"--option=b2.connections={self.b2_connections}")
+
+        if self.pack_size is not None:
+            args.append(f"--pack-size={self.pack_size}")
+
+        if self.compression is not None:
+            args.append(f"--compression={self.compression}")
+
+        if self.limit_upload is not None:
+            args.append(f"--limit-upload={self.limit_upload}")
+
+        return args
+
+    def backup_args(self):
+        args = self.global_args()
+
+        if self.read_concurrency is not None:
+            args.append(f"--read-concurrency={self.read_concurrency}")
+
+        return args
+
+
 @dataclass
 class BackupPlanProps:
     service: BackupService
@@ -72,40 +294,89 @@ class BackupPlanProps:
     backup_script_preamble: str = BASH_PREAMBLE
     storage: BackupStorage | None = None
     setup_healthcheck: bool = True
+    restic_initialized_ttl: int | None = None
+    performance: ResticPerformance | None = None
+    snapshots: list[FilesystemSnapshot] | None = None
+    metrics: bool = False
+    textfile_collector_dir: str | None = None
+    restic_cache: bool = False
+    restic_cache_max_size: int | None = None  # MiB
 
 
-class BackupPlan(TypedComponent(BackupPlanProps)):
+class BackupPlan(StatefulMixin, TypedComponent(BackupPlanProps)):
+    state = JsonState()
+
     @cached_property
     def full_name(self):
         return self.props.service.full_name(self.props.name)
 
+    @property
+    def shared_repository(self):
+        return self.props.service.props.shared_repository
+
+    @property
+    def restic_binary(self):
+        if self.shared_repository:
+            return self.props.service.props.restic_binary
+
+        return self.props.restic_binary
+
+    @property
+    def restic_repo(self):
+        if self.shared_repository:
+            return self.props.service.repo
+
+        return self.repo
+
     def build(self):
         self.backup_precommands = []
+        self.backup_parallel_precommands = []
         self.backup_paths = []
+        self.backup_stdin_sources = []
         self.backup_exclude = []
+        self.daily_unit = None
 
         self.directory = self.props.directory
 
-        if self.props.storage:
-            self._storage = self.props.storage
+        if self.props.restic_cache:
+            self.cache_directory = self.directory.subdir("cache", mode="700")
+
+        if self.shared_repository:
+            # These are set on the service, which owns the shared repository
+            if self.props.storage is not None:
+                raise ValueError(f"{self}: storage is not supported in shared mode")
+            if self.props.restic_initialized_ttl is not None:
+                raise ValueError(
+                    f"{self}: set restic_initialized_ttl on the service in shared mode"
+                )
+            if self.props.restic_binary not in ["restic", self.restic_binary]:
+                raise ValueError(
+                    f"{self}: set restic_binary on the service in shared mode"
+                )
 
         else:
-            self.b2_bucket = self.props.service.props.backblaze.bucket(
-                name=self.full_name,
-            )
+            if self.props.storage:
+                self._storage = self.props.storage
 
-            self.b2_key = self.b2_bucket.key()
+            else:
+                self.b2_bucket = self.props.service.props.backblaze.bucket(
+                    name=self.full_name,
+                    lifecycle_rules=self.props.service.b2_lifecycle_rules,
+                )
 
-            self._storage = B2Storage(self.b2_bucket, self.b2_key)
+                self.b2_key = self.b2_bucket.key()
 
-        self.password = LocalSecret()
+                self._storage = B2Storage(self.b2_bucket, self.b2_key)
 
-        self.repo = Restic(
-            repository=self._storage.restic_repository,
-            password=self.password.value,
-            env=self._storage.restic_env,
-            restic_binary=self.props.restic_binary,
-        )
+            self.password = LocalSecret()
+
+            self.repo = Restic(
+                repository=self._storage.restic_repository,
+                password=self.password.value,
+                env=self._storage.restic_env,
+                restic_binary=self.props.restic_binary,
+                initialized_ttl=self.props.restic_initialized_ttl,
+            )
 
         self.script = self.directory.file(
             name="backup",
@@ -135,24 +406,241 @@ class BackupPlan(TypedComponent(BackupPlanProps)):
         out = StringIO()
         out.write(self.props.backup_script_preamble)
 
+        # One run of a plan at a time; maintenance waits for this lock too
+        out.write(self.plan_lock_script())
+
+        metrics = self.metrics_enabled
+        if metrics:
+            # Before the pre-commands, so a failed run leaves no stale summary
+            out.write(f"summary_log={shlex.quote(str(self.summary_log_path))}\n")
+            out.write(f"rm -f {shlex.quote(str(self.summary_path))}\n")
+            out.write(': > "$summary_log"\n')
+
         for cmd in self.backup_precommands:
             out.write(f"{cmd}\n")
 
-        for key, value in self.repo.extra_env.items():
-            out.write(f"export {key}={shlex.quote(evaluate(value))}\n")
+        if self.backup_parallel_precommands:
+            out.write("precommand_pids=()\n")
+            for cmd in self.backup_parallel_precommands:
+                out.write(f"{cmd} &\n")
+                out.write("precommand_pids+=($!)\n")
+            out.write(PARALLEL_PRECOMMANDS_WAIT)
+
+        out.write(self.env_script())
+
+        if metrics:
+            out.write("backup_started_at=$(date +%s)\n")
+
+        if self.props.restic_cache:
+            out.write(self.cache_check_script())
+
+        # Restic prints just the summary as JSON, which is appended to the log
+        output = ' >> "$summary_log"' if metrics else ""
+
+        snapshots = self.props.snapshots or []
+        if snapshots:
+            out.write("remove_snapshots() {\n")
+            for snapshot in reversed(snapshots):
+                out.write(f"(\n{snapshot.remove_script()}) || true\n")
+            out.write("}\n")
+            out.write("trap remove_snapshots EXIT\n")
+            for snapshot in snapshots:
+                out.write(snapshot.create_script())
+
+        for filename, command in self.backup_stdin_sources:
+            cmd = self.restic_backup_command(
+                "--stdin-from-command",
+                f"--stdin-filename={shlex.quote(filename)}",
+                "--",
+                *(shlex.quote(str(arg)) for arg in evaluate(command)),
+            )
+            out.write(f"{' '.join(cmd)}{output}\n")
+
+        paths = evaluate(self.backup_paths)
+        if paths or not self.backup_stdin_sources:
+            # With snapshots or metrics, the shell must stay around afterwards
+            cmd = [] if (snapshots or metrics) else ["exec"]
+            cmd += self.restic_backup_command()
+            cmd += [shlex.quote(str(self.snapshot_path(path))) for path in paths]
+            cmd += [
+                f"--exclude={shlex.quote(str(self.snapshot_path(path)))}"
+                for path in evaluate(self.backup_exclude)
+            ]
+            out.write(f"{' '.join(cmd)}{output}\n")
+
+        if metrics:
+            report_args = [
+                '"$summary_log"',
+                '"$backup_started_at"',
+                shlex.quote(self.full_name),
+                shlex.quote(str(self.summary_path)),
+                shlex.quote(str(self.textfile_path or "")),
+            ]
+            out.write(f"python3 - {' '.join(report_args)} <<'EOF'\n")
+            out.write(METRICS_REPORT_SCRIPT)
+            out.write("EOF\n")
 
-        cmd = ["exec", self.props.restic_binary, "backup"]
-        cmd += [shlex.quote(str(path)) for path in evaluate(self.backup_paths)]
-        cmd += [
-            f"--exclude={shlex.quote(str(path))}"
-            for path in evaluate(self.backup_exclude)
-        ]
-        out.write(f"{' '.join(cmd)}\n")
+        return out.getvalue()
+
+    def env_script(self):
+        env = dict(self.restic_repo.extra_env)
+        if self.props.restic_cache:
+            env["RESTIC_CACHE_DIR"] = str(self.cache_directory.path)
+
+        return "".join(
+            f"export {key}={shlex.quote(evaluate(value))}\n"
+            for key, value in env.items()
+        )
+
+    def cache_check_script(self):
+        out = StringIO()
+        max_size = self.props.restic_cache_max_size
+        if max_size is not None:
+            size = '"$(du -sm "$RESTIC_CACHE_DIR" | cut -f1)"'
+            out.write(
+                f"if [ {size} -gt {max_size} ]; then\n"
+                f'    echo "Restic cache is over {max_size} MiB, dropping data" >&2\n'
+                f'    rm -rf "$RESTIC_CACHE_DIR"/*/data\n'
+                f"fi\n"
+            )
 
+        out.write(
+            "if ! find \"$RESTIC_CACHE_DIR\" -path '*/index/*' -type f -print -quit"
+            " | grep -q .; then\n"
+            '    echo "Restic cache is cold, the index will be downloaded" >&2\n'
+            "fi\n"
+        )
         return out.getvalue()
 
+    def restic_command(self, *args):
+        performance = self.props.performance or ResticPerformance()
+        return [
+            *performance.wrapper(),
+            self.restic_binary,
+            *args,
+            *performance.global_args(),
+            *self.lock_args(),
+        ]
+
+    def plan_lock_script(self, wait=False):
+        lock_file = shlex.quote(str(self.directory.path / "backup.lock"))
+        if wait:
+            return f"exec 8> {lock_file}\nflock 8\n"
+        return (
+            f"exec 8> {lock_file}\n"
+            "flock -n 8 || {\n"
+            "    echo 'Backup or maintenance already running' >&2\n"
+            "    exit 1\n"
+            "}\n"
+        )
+
+    def lock_args(self):
+        # Wait for exclusive locks (e.g. a prune) instead of failing
+        return ["--retry-lock=2h"]
+
+    @property
+    def metrics_enabled(self):
+        return self.props.metrics or self.props.textfile_collector_dir is not None
+
+    @property
+    def summary_log_path(self):
+        return self.directory.path / "restic-summary.jsonl"
+
+    @property
+    def summary_path(self):
+        return self.directory.path / "last-summary.json"
+
+    @property
+    def textfile_path(self):
+        if self.props.textfile_collector_dir is None:
+            return None
+
+        filename = f"restic-backup-{self.full_name}.prom"
+        return Path(self.props.textfile_collector_dir) / filename
+
+    def snapshot_path(self, path):
+        for snapshot in self.props.snapshots or []:
+            mapped = snapshot.map_path(path)
+            if mapped is not None:
+                return mapped
+
+        return path
+
+    def restic_backup_command(self, *args):
+        performance = self.props.performance or ResticPerformance()
+        return [
+            *performance.wrapper(),
+            self.restic_binary,
+            "backup",
+            *performance.backup_args(),
+            *(["--json", "--quiet"] if self.metrics_enabled else []),
+            *(["--cleanup-cache"] if self.props.restic_cache else []),
+            *self.lock_args(),
+            *(
+                [f"--host={self.full_name}", f"--tag={self.full_name}"]
+                if self.shared_repository
+                else []
+            ),
+            *args,
+        ]
+
+    @property
+    def expected_duration(self):
+        last_duration = self.state.get("last-duration")
+        if last_duration is None:
+            return self.props.service.props.default_backup_duration
+
+        # Leave some headroom, and round up to whole minutes
+        return math.ceil(last_duration * 1.2 / 60) * 60
+
+    def refresh(self):
+        duration = None
+        if self.metrics_enabled:
+            result = self.directory.host.run("cat", str(self.summary_path), check=False)
+            if not result.failed:
+                duration = json.loads(result.stdout)["duration"]
+
+        if duration is None and self.daily_unit is not None:
+            duration = self.daily_unit_duration()
+
+        if duration is not None:
+            self.state["last-duration"] = duration
+
+        return Result()
+
+    def daily_unit_duration(self):
+        # Without metrics, take the last successful run of the daily unit
+        properties = [
+            "ExecMainStartTimestampMonotonic",
+            "ExecMainExitTimestampMonotonic",
+            "ExecMainStatus",
+        ]
+        result = self.directory.host.run(
+            "systemctl",
+            "show",
+            *(f"--property={name}" for name in properties),
+            self.daily_unit,
+            check=False,
+        )
+        if result.failed:
+            return None
+
+        values = dict(
+            line.split("=", 1) for line in result.stdout.splitlines() if "=" in line
+        )
+        start = int(values.get(properties[0]) or 0)
+        end = int(values.get(properties[1]) or 0)
+        if not start or end < start or values.get(properties[2]) != "0":
+            return None
+
+        return round((end - start) / 1e6)
+
     def systemd_timer_service(self, **props):
         props.setdefault("name", f"{self.full_name}-daily")
+        self.daily_unit = f"{props['name']}.service"
+
+        if "on_calendar" not in props:
+            props["on_calendar"] = self.props.service.schedule_slot(self)
 
         return SystemdTimerService(
             host=self.directory.host.sudo(),
@@ -165,12 +653,237 @@ class BackupPlan(TypedComponent(BackupPlanProps)):
         backup_cmd = str(self.script.path)
 
         if self.props.setup_healthcheck:
-            backup_cmd = self.healthcheck.wrap_command(backup_cmd)
+            backup_cmd = self.healthcheck.wrap_command(
+                backup_cmd,
+                ping_body_file=self.summary_path if self.metrics_enabled else None,
+            )
 
-        return f"#!{self.props.shell}\nset -euo pipefail\n\n{backup_cmd}"
+        lock = self.props.service.lock_script
+        return f"#!{self.props.shell}\nset -euo pipefail\n\n{lock}{backup_cmd}"
+
+    def run_restic_on_host(self, *args, **kwargs):
+        # No backup profile here: its nice/ionice and options would slow down
+        # or conflict with interactive restores
+        args = [shlex.quote(str(arg)) for arg in args]
+        cmd = [self.restic_binary, *args, *self.lock_args()]
+        script = (
+            f"{self.props.backup_script_preamble}"
+            f"{self.env_script()}"
+            f"exec {' '.join(cmd)}\n"
+        )
+        return self.directory.host.run(input=script, **kwargs)
+
+    def host_disk_usage(self, path):
+        result = self.directory.host.run("du", "-sb", path, check=False)
+        if result.failed:
+            return 0
+        return int(result.stdout.split()[0])
+
+    def add_commands(self, cli):
+        @cli.forward_command
+        def restic(args):
+            self.restic_repo.run(*args, capture_output=False, exit=True)
+
+        @cli.command()
+        @click.argument("snapshot", default="latest")
+        @click.option("--target", required=True)
+        @click.option("--include", multiple=True)
+        @click.option("--exclude", multiple=True)
+        @click.option("--connections", type=int, help="Parallel B2 connections")
+        @click.option(
+            "--benchmark",
+            is_flag=True,
+            help="Report throughput of the data added to the target",
+        )
+        def restore(snapshot, target, include, exclude, connections, benchmark):
+            args = ["restore", snapshot, f"--target={target}"]
+            args += [f"--include={path}" for path in include]
+            args += [f"--exclude={path}" for path in exclude]
+
+            if connections is None and self.props.performance:
+                connections = self.props.performance.b2_connections
+            if connections:
+                args.append(f"--option=b2.connections={connections}")
+
+            if self.shared_repository:
+                args.append(f"--host={self.full_name}")
+
+            if benchmark:
+                size_before = self.host_disk_usage(target)
+
+            t0 = time.monotonic()
+            result = self.run_restic_on_host(*args, capture_output=False, check=False)
+            elapsed = time.monotonic() - t0
+
+            if result.failed:
+                raise click.exceptions.Exit(result.completed.returncode or 1)
+
+            if benchmark:
+                size = self.host_disk_usage(target) - size_before
+                click.echo(
+                    f"Restored {size / 1e6:.1f} MB in {elapsed:.1f}s "
+                    f"({size / 1e6 / max(elapsed, 0.001):.2f} MB/s)"
+                )
+
+        @cli.command()
+        @click.argument("mountpoint")
+        def mount(mountpoint):
+            self.run_restic_on_host(
+                "mount", mountpoint, capture_output=False, exit=True
+            )
 
-    def add_precommand(self, cmd):
-        self.backup_precommands.append(cmd)
+    def maintenance(self, **props):
+        return ResticMaintenance(
+            plan=self,
+            **props,
+        )
+
+    def add_precommand(self, cmd, parallel=False):
+        if parallel:
+            self.backup_parallel_precommands.append(cmd)
+
+        else:
+            self.backup_precommands.append(cmd)
 
     def add_path(self, path):
         self.backup_paths.append(path)
+
+    def add_stdin_source(self, filename, command):
+        # The output of `command` (a list of arguments) is read by restic and
+        # stored as `filename`, without an intermediate file on disk. If the
+        # command fails, no snapshot is saved. Needs restic 0.17 or newer.
+        self.backup_stdin_sources.append((filename, command))
+
+
+@dataclass
+class ResticMaintenanceProps:
+    plan: BackupPlan
+    keep_last: int | None = None
+    keep_daily: int | None = 7
+    keep_weekly: int | None = 4
+    keep_monthly: int | None = 12
+    keep_yearly: int | None = None
+    max_unused: str = "10%"
+    max_repack_size: str | None = None
+    check_subsets: int | None = 30
+
+
+class ResticMaintenance(TypedComponent(ResticMaintenanceProps)):
+    def build(self):
+        self.script = self.props.plan.directory.file(
+            name="maintenance",
+            content=self.script_content,
+            mode="700",
+        )
+
+    @lazy_property
+    def script_content(self):
+        plan = self.props.plan
+        out = StringIO()
+        out.write(plan.props.backup_script_preamble)
+        # Don't overlap with the plan's backups
+        out.write(plan.props.service.lock_script)
+        out.write(plan.plan_lock_script(wait=True))
+        out.write(plan.env_script())
+
+        forget = ["forget"]
+        if plan.shared_repository:
+            # Only apply the retention policy to this plan's snapshots. Prune
+            # and check run once for the whole repository, in the service's
+            # maintenance, so the prune and check props are not used here.
+            forget.append(f"--host={plan.full_name}")
+        else:
+            forget.append("--prune")
+            forget += prune_args(self.props.max_unused, self.props.max_repack_size)
+        for option in ["last", "daily", "weekly", "monthly", "yearly"]:
+            value = getattr(self.props, f"keep_{option}")
+            if value is not None:
+                forget.append(f"--keep-{option}={value}")
+
+        out.write(f"{' '.join(plan.restic_command(*forget))}\n")
+
+        if self.props.check_subsets and not plan.shared_repository:
+            check = check_args(self.props.check_subsets)
+            out.write(f"{' '.join(plan.restic_command(*check))}\n")
+
+        return out.getvalue()
+
+    def systemd_timer_service(self, **props):
+        props.setdefault("name", f"{self.props.plan.full_name}-maintenance")
+
+        return SystemdTimerService(
+            host=self.props.plan.directory.host.sudo(),
+            exec_start=self.script.path,
+            **props,
+        )
+
+
+@dataclass
+class SharedResticMaintenanceProps:
+    service: BackupService
+    directory: Directory
+    max_unused: str = "10%"
+    max_repack_size: str | None = None
+    check_subsets: int | None = 30
+    backup_script_preamble: str = BASH_PREAMBLE
+
+
+class SharedResticMaintenance(TypedComponent(SharedResticMaintenanceProps)):
+    # Prune and check the shared repository once, for all plans; each plan's
+    # own maintenance only forgets its snapshots. Overlap with backups is
+    # handled by restic's repository lock, with --retry-lock.
+
+    def build(self):
+        self.script = self.props.directory.file(
+            name="maintenance",
+            content=self.script_content,
+            mode="700",
+        )
+
+    def restic_command(self, *args):
+        service = self.props.service
+        return [service.props.restic_binary, *args, "--retry-lock=2h"]
+
+    @lazy_property
+    def script_content(self):
+        service = self.props.service
+        out = StringIO()
+        out.write(self.props.backup_script_preamble)
+        out.write(service.lock_script)
+        for key, value in service.repo.extra_env.items():
+            out.write(f"export {key}={shlex.quote(evaluate(value))}\n")
+
+        prune = [
+            "prune",
+            *prune_args(self.props.max_unused, self.props.max_repack_size),
+        ]
+        out.write(f"{' '.join(self.restic_command(*prune))}\n")
+
+        if self.props.check_subsets:
+            check = check_args(self.props.check_subsets)
+            out.write(f"{' '.join(self.restic_command(*check))}\n")
+
+        return out.getvalue()
+
+    def systemd_timer_service(self, **props):
+        props.setdefault("name", self.props.service.full_name("shared-maintenance"))
+
+        return SystemdTimerService(
+            host=self.props.directory.host.sudo(),
+            exec_start=self.script.path,
+            **props,
+        )
+
+
+def prune_args(max_unused, max_repack_size):
+    args = [f"--max-unused={max_unused}"]
+    if max_repack_size is not None:
+        args.append(f"--max-repack-size={max_repack_size}")
+    return args
+
+
+def check_args(subsets):
+    # Verify a different slice of the pack files each day, so that all data
+    # gets read once every `subsets` runs.
+    subset = f"$(( 10#$(date +%j) % {subsets} + 1 ))/{subsets}"
+    return ["check", f"--read-data-subset={subset}"]
@@ -13,11 +13,18 @@ from opslib.terraform import TerraformProvider
 
 from .docker import Sidecar
 from .localsecret import LocalSecret
+from .terraform import TerraformWorkspace
 
 
-class Cloudflare(TypedComponent()):
+@dataclass
+class CloudflareProps:
+    batch: bool = False
+
+
+class Cloudflare(TypedComponent(CloudflareProps)):
     def build(self):
-        self.provider = TerraformProvider(
+        provider_class = TerraformWorkspace if self.props.batch else TerraformProvider
+        self.provider = provider_class(
             name="cloudflare",
             source="cloudflare/cloudflare",
             version="~> 4.0",
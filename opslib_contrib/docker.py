@@ -1,14 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+import hashlib
+import json
+import re
+import secrets
 import shlex
 from textwrap import dedent
 from typing import Any, Optional
 
 import click
-import yaml
-from opslib import Component, Directory, Lazy, MaybeLazy, Prop, evaluate
+from opslib import Component, Directory, Lazy, MaybeLazy, Prop, evaluate, lazy_property
+from opslib.results import Result
+from opslib.state import JsonState, StatefulMixin
 
+from opslib_contrib.serialize import SERIALIZERS
 
-class DockerCompose(Component):
+
+class DockerCompose(StatefulMixin, Component):
     class Props:
         directory = Prop(Directory)
         services = Prop(Optional[dict], lazy=True)
@@ -17,14 +25,24 @@ class DockerCompose(Component):
         compose_command = Prop(str, default="docker compose")
         filename = Prop(str, default="docker-compose.yml")
         compose_file_version = Prop(Optional[str])
+        serializer = Prop(str, default="yaml")
+        prepull = Prop(bool, default=False)
+        prepull_jobs = Prop(int, default=4)
+
+    state = JsonState()
 
     def build(self):
-        def compose_file_content():
-            return yaml.dump(self.get_compose_file_content(), sort_keys=False)
+        if self.props.prepull:
+            # Defined first, so that images are pulled before the compose
+            # file is uploaded.
+            self.prepull = DockerComposePrepull(
+                compose=self,
+                jobs=self.props.prepull_jobs,
+            )
 
         self.compose_file = self.props.directory.file(
             name=self.props.filename,
-            content=Lazy(compose_file_content),
+            content=self.compose_file_content,
         )
 
         self._up_command_run_after = [self.compose_file]
@@ -42,6 +60,22 @@ class DockerCompose(Component):
             )
             self._up_command_run_after.append(self.env_file)
 
+    @lazy_property
+    def compose_file_content(self):
+        # Rendering YAML is slow for large stacks, so the output is cached in
+        # state, keyed by a digest of the evaluated compose spec. The remote
+        # upload is skipped by opslib when the file content is unchanged.
+        content = self.get_compose_file_content()
+        digest = json_digest([self.props.serializer, content])
+
+        cached = self.state.get("compose-file")
+        if cached and cached["digest"] == digest:
+            return cached["content"]
+
+        rendered = SERIALIZERS[self.props.serializer](content, sort_keys=False)
+        self.state["compose-file"] = dict(digest=digest, content=rendered)
+        return rendered
+
     def get_compose_file_content(self):
         compose = {}
 
@@ -58,16 +92,39 @@ class DockerCompose(Component):
 
         return compose
 
+    def service_fingerprints(self):
+        services = evaluate(self.props.services) or {}
+        secrets = evaluate(self.props.secrets) or {}
+
+        fingerprints = {}
+        for name, service in services.items():
+            spec = json.dumps(service, default=str)
+            referenced = {
+                key: value
+                for key, value in secrets.items()
+                if re.search(rf"\$\{{?{re.escape(key)}\b", spec)
+            }
+            fingerprints[name] = json_digest([service, referenced])
+
+        return fingerprints
+
+    def get_images(self):
+        services = evaluate(self.props.services) or {}
+        return sorted({s["image"] for s in services.values() if s.get("image")})
+
+    def command_script(self, command):
+        return dedent(
+            f"""
+            set -euo pipefail
+            set -x
+            cd {self.props.directory.path}
+            {self.props.compose_command} {command}
+            """
+        )
+
     def command(self, command, run_after=[]):
         return self.props.directory.host.command(
-            input=dedent(
-                f"""
-                set -euo pipefail
-                set -x
-                cd {self.props.directory.path}
-                {self.props.compose_command} {command}
-                """
-            ),
+            input=self.command_script(command),
             run_after=run_after,
         )
 
@@ -84,6 +141,9 @@ class DockerCompose(Component):
     def run(self, *args, **kwargs):
         self.props.directory.run(*self.props.compose_command.split(), *args, **kwargs)
 
+    def batch(self, stop_on_error=False):
+        return ComposeBatch(self, stop_on_error=stop_on_error)
+
     def build_command(self, run_after=[]):
         build = self.command("build", run_after=[self.compose_file, *run_after])
         self._up_command_run_after.append(build)
@@ -94,7 +154,13 @@ class DockerCompose(Component):
         self._up_command_run_after.append(pull)
         return pull
 
-    def up_command(self, run_after=[]):
+    def up_command(self, run_after=[], incremental=False):
+        if incremental:
+            return DockerComposeUp(
+                compose=self,
+                run_after=[*self._up_command_run_after, *run_after],
+            )
+
         return self.command(
             "up -d", run_after=[*self._up_command_run_after, *run_after]
         )
@@ -109,8 +175,380 @@ class DockerCompose(Component):
         def run(args):
             self.run(*args, capture_output=False, exit=True)
 
+        @cli.command()
+        @click.option("-x", "--stop-on-error", is_flag=True)
+        @click.argument("commands", nargs=-1)
+        def batch(stop_on_error, commands):
+            batch = self.batch(stop_on_error=stop_on_error)
+            for command in commands:
+                batch.add(*shlex.split(command))
+
+            results = batch.run()
+            for result in results:
+                click.echo(f"==> {' '.join(result.args)} [exit {result.exit_code}]")
+                click.echo(result.output, nl=False)
+
+            if len(results) < len(commands):
+                click.echo(
+                    f"==> batch stopped after {len(results)} of {len(commands)} "
+                    f"commands [exit {batch.result.completed.returncode}]",
+                    err=True,
+                )
+                click.echo(batch.result.stderr, nl=False, err=True)
+                raise click.exceptions.Exit(batch.result.completed.returncode or 1)
+
+            if any(r.failed for r in results):
+                raise click.exceptions.Exit(1)
+
+
+PREPULL_SCRIPT = """\
+set -euo pipefail
+pull_image() {
+    # Tags can move, so only digest-pinned images are taken as they are
+    if [[ "$1" != *@sha256:* ]] || ! docker image inspect "$1" > /dev/null 2>&1; then
+        docker pull --quiet "$1" >&2 || return
+    fi
+    digest="$(docker image inspect --format '{{index .RepoDigests 0}}' "$1" || true)"
+    echo "prepulled $1 $digest"
+}
+export -f pull_image
+"""
+
+
+class DockerComposePrepull(StatefulMixin, Component):
+    # Pull the images referenced by the compose services, in parallel. Pulled
+    # images are remembered in state, along with their digest. Images pinned
+    # to a digest are not checked again; tags are pulled on every deploy, and
+    # the deploy counts as a change only when their digest moved.
+
+    class Props:
+        compose = Prop(DockerCompose)
+        jobs = Prop(int, default=4)
+
+    state = JsonState()
+
+    def script(self, images):
+        args = " ".join(shlex.quote(image) for image in images)
+        return (
+            f"{PREPULL_SCRIPT}"
+            f"printf '%s\\0' {args} "
+            f"| xargs -0 -n 1 -P {self.props.jobs} bash -c 'pull_image \"$1\"' _\n"
+        )
+
+    def pull(self, images):
+        result = self.props.compose.props.directory.host.run(
+            input=self.script(images),
+        )
+
+        digests = {}
+        for line in result.stdout.splitlines():
+            if line.startswith("prepulled "):
+                _, image, *digest = line.split()
+                if digest:
+                    digests[image] = digest[0]
+
+        return result, digests
+
+    def deploy(self, dry_run=False):
+        images = self.props.compose.get_images()
+        pulled = self.state.get("images", {})
+        missing = [
+            image for image in images if not (is_pinned(image) and pulled.get(image))
+        ]
+
+        if not missing:
+            return Result()
+
+        if dry_run:
+            return Result(changed=True, output="".join(f"{i}\n" for i in missing))
+
+        def _run():
+            result, digests = self.pull(missing)
+            # Images whose digest could not be read are checked again next time
+            state = {i: pulled[i] for i in images if i not in missing}
+            state.update({i: digests[i] for i in missing if i in digests})
+            self.state["images"] = state
+            changed = any(digests.get(image) != pulled.get(image) for image in missing)
+            return Result(changed=changed, output=result.output)
+
+        return Lazy(_run)
+
+    def add_commands(self, cli):
+        @cli.command()
+        def pull():
+            images = self.props.compose.get_images()
+            result, digests = self.pull(images)
+            self.state["images"] = digests
+            for image in images:
+                click.echo(f"{image} {digests.get(image, '-')}")
+
+
+def is_pinned(image):
+    return "@sha256:" in image
+
+
+class DockerComposeUp(StatefulMixin, Component):
+    # Like `up_command`, but when only the compose or env files changed, it
+    # runs `up -d` just for the services whose definition (or referenced
+    # secrets) changed since the last run.
+
+    class Props:
+        compose = Prop(DockerCompose)
+        run_after = Prop(list, default=[])
+
+    state = JsonState()
+
+    def build(self):
+        compose = self.props.compose
+        files = [compose.compose_file]
+        if compose.props.secrets is not None:
+            files.append(compose.env_file)
+
+        for other in self.props.run_after:
+            if other in files:
+                other.on_change.add(self._set_must_run)
+            else:
+                other.on_change.add(self._set_must_run_all)
+
+    def _set_must_run(self):
+        self.state["must-run"] = True
+
+    def _set_must_run_all(self):
+        self.state.update({"must-run": True, "must-run-all": True})
+
+    def get_changed_services(self, fingerprints):
+        previous = self.state.get("fingerprints")
+        if self.state.get("must-run-all") or previous is None:
+            return None
+
+        if set(previous) - set(fingerprints):
+            # Services were removed; let compose reconcile the whole project
+            return None
+
+        compose = self.props.compose.get_compose_file_content()
+        compose.pop("services", None)
+        if json_digest(compose) != self.state.get("compose-fingerprint"):
+            return None
+
+        return [name for name, fp in fingerprints.items() if previous.get(name) != fp]
+
+    def deploy(self, dry_run=False):
+        if not self.state.get("must-run"):
+            return Result()
+
+        compose = self.props.compose
+        fingerprints = compose.service_fingerprints()
+        services = self.get_changed_services(fingerprints)
+
+        if dry_run:
+            output = "all services" if services is None else " ".join(services)
+            return Result(changed=True, output=f"up -d: {output}\n")
+
+        def _run():
+            if services is None:
+                command = "up -d"
+            else:
+                command = " ".join(["up -d", *(shlex.quote(s) for s in services)])
+
+            result = None
+            if services != []:
+                result = compose.props.directory.host.run(
+                    input=compose.command_script(command),
+                    capture_output=False,
+                )
+
+            rest = compose.get_compose_file_content()
+            rest.pop("services", None)
+            self.state.update(
+                {
+                    "must-run": False,
+                    "must-run-all": False,
+                    "fingerprints": fingerprints,
+                    "compose-fingerprint": json_digest(rest),
+                }
+            )
+            return result or Result()
+
+        return Lazy(_run)
+
+
+@dataclass
+class ComposeBatchResult:
+    args: tuple[str, ...]
+    exit_code: int
+    output: str
+
+    @property
+    def failed(self):
+        return self.exit_code != 0
+
+
+class ComposeBatch:
+    # Queue several compose commands and run them as a single script, in one
+    # remote shell session, instead of paying for a connection each time.
+
+    def __init__(self, compose, stop_on_error=False):
+        self.compose = compose
+        self.stop_on_error = stop_on_error
+        self.commands = []
+        self.result = None
+
+    def add(self, *args):
+        self.commands.append(args)
+        return self
+
+    def script(self, marker):
+        path = self.compose.props.directory.path
+        lines = [f"cd {shlex.quote(str(path))} || exit"]
+
+        for n, args in enumerate(self.commands):
+            command = " ".join(shlex.quote(str(arg)) for arg in args)
+            lines += [
+                f"echo {marker} begin {n}",
+                # Don't let the command read the rest of the script from stdin
+                f"{self.compose.props.compose_command} {command} </dev/null 2>&1",
+                "batch_exit_code=$?",
+                f"echo {marker} exit {n} $batch_exit_code",
+            ]
+            if self.stop_on_error:
+                lines.append('[ "$batch_exit_code" = 0 ] || exit "$batch_exit_code"')
+
+        return "".join(f"{line}\n" for line in lines)
+
+    def run(self):
+        marker = f"opslib-batch-{secrets.token_hex(8)}"
+        result = self.compose.props.directory.host.run(
+            input=self.script(marker),
+            check=False,
+        )
+        # Kept for diagnosing a session that died before all commands ran
+        self.result = result
+
+        results = []
+        output = None
+        for line in result.stdout.splitlines(keepends=True):
+            if line.startswith(f"{marker} begin "):
+                output = []
+
+            elif line.startswith(f"{marker} exit "):
+                n, exit_code = line.split()[2:]
+                results.append(
+                    ComposeBatchResult(
+                        args=self.commands[int(n)],
+                        exit_code=int(exit_code),
+                        output="".join(output or []),
+                    )
+                )
+                output = None
+
+            elif output is not None:
+                output.append(line)
+
+        return results
+
 
 @dataclass
 class Sidecar:
     service: dict[str, Any]
     secrets: dict[str, MaybeLazy[str]]
+
+
+class DockerComposeFleet(Component):
+    class Props:
+        members = Prop(list)
+        max_workers = Prop(int, default=8)
+
+    @property
+    def members(self) -> list[DockerCompose]:
+        return self.props.members
+
+    def command(self, *commands):
+        return DockerComposeFleetCommand(
+            fleet=self,
+            commands=list(commands),
+        )
+
+    def up_command(self, build=False, pull=False):
+        commands = []
+        if build:
+            commands.append("build")
+        if pull:
+            commands.append("pull")
+        commands.append("up -d")
+        return self.command(*commands)
+
+    def run_member(self, member, *commands):
+        script = "".join(member.command_script(command) for command in commands)
+        return member.props.directory.host.run(input=script, check=False)
+
+    def run_all(self, members, *commands):
+        with ThreadPoolExecutor(max_workers=self.props.max_workers) as pool:
+            results = pool.map(lambda m: self.run_member(m, *commands), members)
+            return dict(zip(members, results))
+
+    def add_commands(self, cli):
+        @cli.command(context_settings=dict(ignore_unknown_options=True))
+        @click.argument("args", nargs=-1, type=click.UNPROCESSED)
+        def run(args):
+            command = " ".join(shlex.quote(arg) for arg in args)
+            results = self.run_all(self.members, command)
+            click.echo(format_fleet_results(results))
+            if any(result.failed for result in results.values()):
+                raise click.exceptions.Exit(1)
+
+
+class DockerComposeFleetCommand(StatefulMixin, Component):
+    # Must be defined after the fleet members, so that it's deployed after
+    # their compose files are uploaded.
+
+    class Props:
+        fleet = Prop(DockerComposeFleet)
+        commands = Prop(list)
+
+    state = JsonState()
+
+    def build(self):
+        for member in self.props.fleet.members:
+            for other in member._up_command_run_after:
+                other.on_change.add(lambda member=member: self._set_must_run(member))
+
+    def _set_must_run(self, member):
+        must_run = set(self.state.get("must-run", []))
+        must_run.add(str(member))
+        self.state["must-run"] = sorted(must_run)
+
+    def deploy(self, dry_run=False):
+        must_run = set(self.state.get("must-run", []))
+        pending = [m for m in self.props.fleet.members if str(m) in must_run]
+
+        if not pending:
+            return Result()
+
+        if dry_run:
+            return Result(
+                changed=True,
+                output="".join(f"{member}\n" for member in pending),
+            )
+
+        def _run():
+            results = self.props.fleet.run_all(pending, *self.props.commands)
+            succeeded = {str(m) for m, result in results.items() if not result.failed}
+            self.state["must-run"] = sorted(must_run - succeeded)
+            return Result(
+                changed=True,
+                output=format_fleet_results(results),
+                failed=any(result.failed for result in results.values()),
+            )
+
+        return Lazy(_run)
+
+
+def json_digest(data):
+    return hashlib.sha256(json.dumps(data, default=str).encode("utf8")).hexdigest()
+
+
+def format_fleet_results(results):
+    return "".join(
+        f"==> {member} [{'failed' if result.failed else 'ok'}]\n{result.output}"
+        for member, result in results.items()
+    )
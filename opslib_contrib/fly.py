@@ -4,15 +4,18 @@ from opslib import run
 from opslib.components import TypedComponent
 from opslib.terraform import TerraformProvider
 
+from .terraform import TerraformWorkspace
+
 
 @dataclass
 class FlyProps:
-    pass
+    batch: bool = False
 
 
 class Fly(TypedComponent(FlyProps)):
     def build(self):
-        self.provider = TerraformProvider(
+        provider_class = TerraformWorkspace if self.props.batch else TerraformProvider
+        self.provider = provider_class(
             name="fly",
             source="andrewbaxter/fly",
             version="~> 0.1.13",
@@ -1,13 +1,19 @@
+import shlex
+
 from opslib import Component, Prop, evaluate
 from opslib.terraform import TerraformProvider
 
+from .terraform import TerraformWorkspace
+
 
 class Healthchecks(Component):
     class Props:
         api_key = Prop(str)
+        batch = Prop(bool, default=False)
 
     def build(self):
-        self.provider = TerraformProvider(
+        provider_class = TerraformWorkspace if self.props.batch else TerraformProvider
+        self.provider = provider_class(
             name="healthchecksio",
             source="kristofferahl/healthchecksio",
             version="~> 1.10.0",
@@ -68,14 +74,26 @@ class HealthchecksCheck(Component):
     def url(self):
         return self.check.output["ping_url"]
 
-    def wrap_command(self, command):
+    def wrap_command(self, command, ping_body_file=None):
         url = evaluate(self.url)
+
+        ping = f"curl -s {url}/$healthchecks_exit_code -o /dev/null"
+        if ping_body_file:
+            body = shlex.quote(str(ping_body_file))
+            ping = (
+                f"if [ -f {body} ]; then\n"
+                f"{ping} --data-binary @{body}\n"
+                f"else\n"
+                f"{ping}\n"
+                f"fi"
+            )
+
         return (
             f"(\n"
             f"curl -s {url}/start -o /dev/null\n"
             f"healthchecks_exit_code=0\n"
             f"{command} || healthchecks_exit_code=$?\n"
-            f"curl -s {url}/$healthchecks_exit_code -o /dev/null\n"
+            f"{ping}\n"
             f"exit $healthchecks_exit_code\n"
             f")\n"
         )
@@ -46,7 +46,7 @@ class Paperless(TypedComponent(PaperlessProps)):
             secrets=self.sidecar.secrets if self.sidecar else None,
         )
 
-        self.up = self.compose.up_command(run_after=[self.env_file])
+        self.up = self.compose.up_command(run_after=[self.env_file], incremental=True)
 
     @lazy_property
     def env_file_content(self):
@@ -130,11 +130,36 @@ class Paperless(TypedComponent(PaperlessProps)):
 
         return services
 
-    def backup_to(self, plan: BackupPlan):
+    def backup_to(
+        self,
+        plan: BackupPlan,
+        incremental=False,
+        compare_checksums=False,
+        archive=True,
+        thumbnails=True,
+    ):
+        exporter_args = ["/backup_volume"]
+
+        if incremental:
+            # Keep the previous export and only rewrite what changed: one
+            # manifest per document, and files of deleted documents removed.
+            exporter_args += ["--split-manifest", "--delete"]
+
+        if compare_checksums:
+            exporter_args.append("--compare-checksums")
+
+        if not archive:
+            exporter_args.append("--no-archive")
+
+        if not thumbnails:
+            exporter_args.append("--no-thumbnail")
+
         plan.add_precommand(
             "("
             f"cd {shlex.quote(str(self.directory.path))}"
-            " && docker compose exec -T webserver document_exporter /backup_volume"
-            ")"
+            " && docker compose exec -T webserver document_exporter"
+            f" {' '.join(exporter_args)}"
+            ")",
+            parallel=True,
         )
         plan.add_path(self.backup_volume.path)
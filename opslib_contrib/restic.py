@@ -1,6 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from opslib import Lazy, MaybeLazy, evaluate, run
-from opslib.components import TypedComponent
+from functools import cached_property
+import time
+
+from opslib import Component, Lazy, MaybeLazy, evaluate, run
+from opslib.components import TypedComponent, walk
 from opslib.results import OperationError, Result
 from opslib.state import JsonState, StatefulMixin
 
@@ -11,6 +15,9 @@ class ResticProps:
     password: MaybeLazy[str]
     env: MaybeLazy[dict | None]
     restic_binary: str = "restic"
+    initialized_probe: tuple[str, ...] = ("cat", "config")
+    initialized_ttl: int | None = None
+    cache_dir: str | None = None
 
 
 class Restic(StatefulMixin, TypedComponent(ResticProps)):
@@ -29,21 +36,50 @@ class Restic(StatefulMixin, TypedComponent(ResticProps)):
         )
 
     def run(self, *args, **kwargs):
-        return run(self.props.restic_binary, *args, **kwargs, extra_env=self.extra_env)
+        extra_env = self.extra_env
+        if self.props.cache_dir:
+            # Only for local runs; `extra_env` also ends up in host scripts
+            extra_env["RESTIC_CACHE_DIR"] = self.props.cache_dir
+
+        return run(self.props.restic_binary, *args, **kwargs, extra_env=extra_env)
+
+    @cached_property
+    def refresh_coordinator(self):
+        for component in walk(self._meta.stack):
+            if isinstance(component, ResticRefresh) and self in component.repositories:
+                return component
 
     def refresh(self):
+        if self.refresh_coordinator is not None:
+            return self.refresh_coordinator.take(self)
+
+        return self.probe()
+
+    def probe(self):
+        ttl = self.props.initialized_ttl
+        checked_at = self.state.get("initialized-checked-at")
+        if ttl is not None and self.initialized and checked_at is not None:
+            if time.time() - checked_at < ttl:
+                return Result()
+
         try:
-            self.run("list", "index")
-            self.state["initialized"] = True
+            self.run(*self.props.initialized_probe)
+            initialized = True
 
         except OperationError as error:
             marker = "Is there a repository at the following location?"
             if marker not in error.result.output:
                 raise
 
-            self.state["initialized"] = False
+            initialized = False
 
-        return Result(changed=not self.state["initialized"])
+        self.state.update(
+            {
+                "initialized": initialized,
+                "initialized-checked-at": time.time(),
+            }
+        )
+        return Result(changed=not initialized)
 
     def deploy(self, dry_run=False):
         if self.initialized:
@@ -63,3 +99,84 @@ class Restic(StatefulMixin, TypedComponent(ResticProps)):
         @cli.forward_command
         def run(args):
             self.run(*args, capture_output=False, exit=True)
+
+
+@dataclass
+class ResticRefreshProps:
+    root: Component
+    max_workers: int = 8
+
+
+class ResticRefresh(TypedComponent(ResticRefreshProps)):
+    # Probe all Restic repositories under `root` in parallel, the first time
+    # any of them (or this component) is refreshed. Each repository then
+    # takes its own result out of `_pending`, exactly once.
+
+    def build(self):
+        self._pending = None
+        self._outcomes = {}
+
+    @cached_property
+    def repositories(self):
+        return [c for c in walk(self.props.root) if isinstance(c, Restic)]
+
+    def _prefetch(self):
+        def _probe(repo):
+            try:
+                return repo.probe()
+
+            except Exception as error:
+                return error
+
+        with ThreadPoolExecutor(max_workers=self.props.max_workers) as pool:
+            outcomes = pool.map(_probe, self.repositories)
+            self._outcomes = dict(zip(self.repositories, outcomes))
+
+        self._pending = dict(self._outcomes)
+
+    def take(self, repo):
+        if self._pending is None:
+            self._prefetch()
+
+        if repo not in self._pending:
+            return repo.probe()
+
+        outcome = self._pending.pop(repo)
+        if isinstance(outcome, Exception):
+            raise outcome
+
+        return outcome
+
+    def refresh(self):
+        if self._pending is None:
+            # Repositories further down the tree will take their results
+            self._prefetch()
+
+        else:
+            # Repositories got here first; drop what nobody claimed
+            self._pending.clear()
+
+        outcomes, self._outcomes = self._outcomes, {}
+
+        def describe(outcome):
+            if isinstance(outcome, OperationError):
+                return "failed"
+            if isinstance(outcome, Exception):
+                return f"failed: {outcome}"
+            return "not initialized"
+
+        failed = [
+            repo for repo, outcome in outcomes.items() if isinstance(outcome, Exception)
+        ]
+        changed = [
+            repo
+            for repo, outcome in outcomes.items()
+            if not isinstance(outcome, Exception) and outcome.changed
+        ]
+        return Result(
+            changed=bool(changed),
+            failed=bool(failed),
+            output="".join(
+                f"{repo}: {describe(outcomes[repo])}\n" for repo in failed + changed
+            ),
+        )
@@ -0,0 +1,25 @@
+import json
+
+import yaml
+
+try:
+    from yaml import CDumper as YamlDumper
+
+except ImportError:
+    from yaml import Dumper as YamlDumper
+
+
+def dump_yaml(data, sort_keys=True):
+    return yaml.dump(data, Dumper=YamlDumper, sort_keys=sort_keys)
+
+
+def dump_json(data, sort_keys=True):
+    # JSON is valid YAML, and the C encoder is much faster than any YAML
+    # emitter. Docker Compose reads it just fine.
+    return json.dumps(data, indent=2, sort_keys=sort_keys, default=str) + "\n"
+
+
+SERIALIZERS = {
+    "yaml": dump_yaml,
+    "json": dump_json,
+}
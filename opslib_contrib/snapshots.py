@@ -0,0 +1,138 @@
+import shlex
+from dataclasses import dataclass
+from pathlib import Path, PurePosixPath
+
+
+def q(value):
+    return shlex.quote(str(value))
+
+
+class FilesystemSnapshot:
+    source: str | Path
+    path: str | Path
+
+    def create_script(self) -> str:
+        ...
+
+    def remove_script(self) -> str:
+        ...
+
+    def map_path(self, path):
+        try:
+            relative = PurePosixPath(path).relative_to(self.source)
+
+        except ValueError:
+            return None
+
+        return PurePosixPath(self.path) / relative
+
+
+@dataclass
+class BtrfsSnapshot(FilesystemSnapshot):
+    source: str | Path  # a btrfs subvolume
+    path: str | Path
+
+    def create_script(self):
+        return (
+            f"btrfs subvolume delete {q(self.path)} > /dev/null 2>&1 || true\n"
+            f"btrfs subvolume snapshot -r {q(self.source)} {q(self.path)}\n"
+        )
+
+    def remove_script(self):
+        return f"btrfs subvolume delete {q(self.path)}\n"
+
+
+@dataclass
+class ZfsSnapshot(FilesystemSnapshot):
+    dataset: str
+    source: str | Path  # mountpoint of the dataset
+    name: str = "restic-backup"
+
+    @property
+    def path(self):
+        return PurePosixPath(self.source) / ".zfs" / "snapshot" / self.name
+
+    def create_script(self):
+        snapshot = q(f"{self.dataset}@{self.name}")
+        return (
+            f"zfs destroy {snapshot} > /dev/null 2>&1 || true\n"
+            f"zfs snapshot {snapshot}\n"
+        )
+
+    def remove_script(self):
+        return f"zfs destroy {q(f'{self.dataset}@{self.name}')}\n"
+
+
+@dataclass
+class LvmSnapshot(FilesystemSnapshot):
+    volume_group: str
+    logical_volume: str
+    source: str | Path  # mountpoint of the logical volume
+    path: str | Path  # where the snapshot gets mounted
+    size: str = "5G"
+    mount_options: str = "ro"
+
+    @property
+    def snapshot_volume(self):
+        return f"{self.volume_group}/{self.logical_volume}-backup"
+
+    def create_script(self):
+        origin = f"{self.volume_group}/{self.logical_volume}"
+        return (
+            f"umount {q(self.path)} > /dev/null 2>&1 || true\n"
+            f"lvremove -f {q(self.snapshot_volume)} > /dev/null 2>&1 || true\n"
+            f"lvcreate --snapshot --size {q(self.size)}"
+            f" --name {q(f'{self.logical_volume}-backup')} {q(origin)}\n"
+            f"mkdir -p {q(self.path)}\n"
+            f"mount -o {q(self.mount_options)}"
+            f" {q(f'/dev/{self.snapshot_volume}')} {q(self.path)}\n"
+        )
+
+    def remove_script(self):
+        return f"umount {q(self.path)}\nlvremove -f {q(self.snapshot_volume)}\n"
+
+
+@dataclass
+class ReflinkSnapshot(FilesystemSnapshot):
+    # Not atomic, but with reflinks the copy is fast and takes no extra space
+    # on filesystems that support them (XFS, btrfs, bcachefs).
+    source: str | Path
+    path: str | Path
+
+    def create_script(self):
+        return (
+            f"rm -rf {q(self.path)}\n"
+            f"mkdir -p {q(PurePosixPath(self.path).parent)}\n"
+            f"cp -a --reflink=auto {q(self.source)} {q(self.path)}\n"
+        )
+
+    def remove_script(self):
+        return f"rm -rf {q(self.path)}\n"
+
+
+@dataclass
+class AutoSnapshot(FilesystemSnapshot):
+    # A btrfs snapshot if `source` is a btrfs subvolume, otherwise a reflink
+    # copy. Either way, the frozen tree shows up at `path`.
+    source: str | Path
+    path: str | Path
+
+    def create_script(self):
+        btrfs = BtrfsSnapshot(self.source, self.path)
+        reflink = ReflinkSnapshot(self.source, self.path)
+        return (
+            f"if btrfs subvolume show {q(self.source)} > /dev/null 2>&1; then\n"
+            f"{btrfs.create_script()}"
+            f"else\n"
+            f"{reflink.create_script()}"
+            f"fi\n"
+        )
+
+    def remove_script(self):
+        return (
+            f"if btrfs subvolume show {q(self.path)} > /dev/null 2>&1; then\n"
+            f"btrfs subvolume delete {q(self.path)}\n"
+            f"else\n"
+            f"rm -rf {q(self.path)}\n"
+            f"fi\n"
+        )
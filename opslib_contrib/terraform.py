@@ -0,0 +1,367 @@
+import hashlib
+import json
+import os
+import re
+from functools import cached_property
+from pathlib import Path
+from typing import Optional
+
+import click
+
+from opslib import Component, Lazy, Prop, evaluate
+from opslib.lazy import NotAvailable, is_lazy
+from opslib.local import run
+from opslib.results import Result
+from opslib.state import JsonState, StatefulMixin
+from opslib.terraform import TerraformProvider, TerraformResult
+
+PLAN_ITEM = re.compile(r"^\s*# \S+ (will|must) be ")
+
+
+def config_digest(config):
+    buffer = json.dumps(config, sort_keys=True).encode("utf8")
+    return hashlib.sha256(buffer).hexdigest()
+
+
+def plan_excerpt(output, address):
+    lines = []
+    for line in output.splitlines():
+        if PLAN_ITEM.match(line):
+            if lines:
+                break
+            if line.strip().startswith(f"# {address} "):
+                lines.append(line)
+
+        elif lines:
+            if line.startswith("Plan:"):
+                break
+            lines.append(line)
+
+    return "\n".join(lines).strip()
+
+
+class SharedCacheProvider(TerraformProvider):
+    # Terraform's conventional per-user cache, shared by every workspace,
+    # instead of one download per provider component
+    @cached_property
+    def plugin_cache_path(self):
+        path = Path.home() / ".terraform.d" / "plugin-cache"
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+
+class TerraformOutput(Lazy):
+    def __init__(self, resource, key):
+        super().__init__(resource.get_output, key)
+        self.resource = resource
+        self.key = key
+
+
+class TerraformWorkspace(StatefulMixin, Component):
+    # Drop-in replacement for TerraformProvider that applies all of its
+    # resources in one Terraform workspace, when the first one is deployed.
+    # Resources removed from the stack are kept, like orphaned standalone
+    # resources would be, until `orphans --destroy`.
+
+    class Props:
+        name = Prop(str)
+        source = Prop(Optional[str])
+        version = Prop(Optional[str])
+        config = Prop(Optional[dict])
+
+    state = JsonState()
+
+    def build(self):
+        self._resources = []
+        self._destroyed = set()
+        self._results = []
+        self._plans = {}
+        self._refresh_result = None
+        self._output_values = None
+        self._initialized = False
+        self._missing = {}
+
+        self.provider = SharedCacheProvider(
+            name=self.props.name,
+            source=self.props.source,
+            version=self.props.version,
+            config=self.props.config,
+        )
+
+    def resource(self, **props):
+        return TerraformBatchResource(
+            workspace=self,
+            **props,
+        )
+
+    def data(self, **props):
+        return self.provider.data(**props)
+
+    def register(self, resource):
+        self._resources.append(resource)
+
+    @cached_property
+    def tf_path(self):
+        return self._meta.statedir.path / "terraform"
+
+    def run(self, *args, **kwargs):
+        extra_env = {"TF_IN_AUTOMATION": "true"}
+        if not os.environ.get("TF_PLUGIN_CACHE_DIR"):
+            extra_env["TF_PLUGIN_CACHE_DIR"] = str(self.provider.plugin_cache_path)
+
+        return run("terraform", *args, **kwargs, cwd=self.tf_path, extra_env=extra_env)
+
+    def _render_value(self, value, refs):
+        if isinstance(value, TerraformOutput) and value.resource.workspace is self:
+            refs.add(value.resource.address)
+            return f"${{{value.resource.address}.{value.key}}}"
+
+        if is_lazy(value):
+            return self._render_value(evaluate(value), refs)
+
+        if isinstance(value, dict):
+            return {k: self._render_value(v, refs) for k, v in value.items()}
+
+        if isinstance(value, list):
+            return [self._render_value(i, refs) for i in value]
+
+        return value
+
+    def render(self, keep_orphans=True):
+        previous = self.state.get("rendered", {})
+        rendered = {}
+        # Resources whose current config is not in the workspace; their
+        # deploy fails, like a standalone resource's would
+        self._missing = {}
+
+        for resource in self._resources:
+            if resource in self._destroyed:
+                continue
+
+            address = resource.address
+            refs = set()
+            try:
+                args = self._render_value(resource.props.args, refs)
+
+            except NotAvailable as error:
+                self._missing[address] = error
+                if address in previous:
+                    rendered[address] = previous[address]
+                continue
+
+            rendered[address] = dict(
+                args=args,
+                output=resource.props.output or [],
+                refs=sorted(refs),
+            )
+
+        if keep_orphans:
+            for address in self.orphans():
+                rendered[address] = previous[address]
+
+        # Resources that refer to a resource which got left out fall back to
+        # their previous rendering, or get left out themselves.
+        while True:
+            dangling = [
+                address
+                for address, block in rendered.items()
+                if any(ref not in rendered for ref in block["refs"])
+            ]
+            if not dangling:
+                return rendered
+
+            for address in dangling:
+                self._missing.setdefault(
+                    address,
+                    NotAvailable(f"{address}: depends on an unavailable resource"),
+                )
+                if address in previous and rendered[address] != previous[address]:
+                    rendered[address] = previous[address]
+                else:
+                    del rendered[address]
+
+    def orphans(self):
+        registered = {resource.address for resource in self._resources}
+        previous = self.state.get("rendered", {})
+        return [address for address in previous if address not in registered]
+
+    def config(self, rendered):
+        config = dict(self.provider.config)
+        resources = {}
+        outputs = {}
+
+        for address, block in rendered.items():
+            type, name = address.split(".", 1)
+            resources.setdefault(type, {})[name] = block["args"]
+            for key in block["output"]:
+                outputs[f"{name}__{key}"] = {
+                    "value": f"${{{address}.{key}}}",
+                    "sensitive": True,
+                }
+
+        if resources:
+            config["resource"] = resources
+        if outputs:
+            config["output"] = outputs
+
+        return config
+
+    def _init(self, config):
+        self.tf_path.mkdir(exist_ok=True, mode=0o700)
+        (self.tf_path / "main.tf.json").write_text(json.dumps(config, indent=2))
+
+        if self._initialized:
+            return
+
+        digest = config_digest(self.provider.config)
+        if (
+            digest != self.state.get("init-digest")
+            or not (self.tf_path / ".terraform").exists()
+        ):
+            self.run("init", "-upgrade")
+            self.state["init-digest"] = digest
+
+        self._initialized = True
+
+    def plan(self, keep_orphans=True):
+        rendered = self.render(keep_orphans=keep_orphans)
+        config = self.config(rendered)
+        digest = config_digest(config)
+        if digest not in self._plans:
+            if digest == self.state.get("applied-digest"):
+                self._plans[digest] = None
+            else:
+                self._init(config)
+                self._plans[digest] = TerraformResult(
+                    self.run("plan", "-refresh=false")
+                )
+        return self._plans[digest]
+
+    def apply(self, keep_orphans=True):
+        rendered = self.render(keep_orphans=keep_orphans)
+        config = self.config(rendered)
+        digest = config_digest(config)
+        if digest == self.state.get("applied-digest"):
+            return
+
+        self._init(config)
+        result = TerraformResult(self.run("apply", "-auto-approve", "-refresh=false"))
+        self._results.append(result)
+        self._output_values = None
+        self.state.update(
+            {
+                "rendered": rendered,
+                "applied-digest": digest,
+            }
+        )
+        return result
+
+    def destroy(self, dry_run=False):
+        # Tear down every resource while the Terraform state is still there
+        self._destroyed.update(self._resources)
+        if dry_run:
+            return self.plan(keep_orphans=False) or Result()
+        return self.apply(keep_orphans=False) or Result()
+
+    def refresh(self):
+        if self._refresh_result is None:
+            config = self.config(self.render())
+            self._init(config)
+            self.run("refresh")
+            self._refresh_result = TerraformResult(self.run("plan"))
+            if self._refresh_result.changed:
+                # Force the next deploy to apply, even if the config is the same
+                self.state["applied-digest"] = None
+        return self._refresh_result
+
+    def result_for(self, resource, results):
+        output = [
+            plan_excerpt(result.output, resource.address)
+            for result in results
+            if result and result.changed
+        ]
+        output = [excerpt for excerpt in output if excerpt]
+        return Result(changed=bool(output), output="\n".join(output))
+
+    def get_output(self, name):
+        if self._output_values is None:
+            if not (self.tf_path / "terraform.tfstate").exists():
+                raise NotAvailable(f"{self!r}: output {name!r} not available")
+            self._output_values = json.loads(self.run("output", "-json").stdout)
+
+        try:
+            return self._output_values[name]["value"]
+
+        except KeyError:
+            raise NotAvailable(f"{self!r}: output {name!r} not available")
+
+    def add_commands(self, cli):
+        @cli.forward_command
+        def terraform(args):
+            self._init(self.config(self.render()))
+            self.run(*args, capture_output=False, exit=True)
+
+        @cli.command(name="orphans")
+        @click.option("--destroy", is_flag=True)
+        def orphans_command(destroy):
+            for address in self.orphans():
+                click.echo(address)
+
+            if destroy and self.orphans():
+                result = self.apply(keep_orphans=False)
+                if result:
+                    click.echo(result.output)
+
+
+class TerraformBatchResource(Component):
+    # Same props and `output` as TerraformResource, applied by the workspace
+    class Props:
+        workspace = Prop(TerraformWorkspace)
+        type = Prop(str)
+        args = Prop(dict, default={}, lazy=True)
+        output = Prop(Optional[list])
+
+    def build(self):
+        self.workspace.register(self)
+
+    @property
+    def workspace(self):
+        return self.props.workspace
+
+    @cached_property
+    def address(self):
+        name = re.sub(r"[^A-Za-z0-9_-]", "_", self._meta.full_name)
+        return f"{self.props.type}.{name}"
+
+    @cached_property
+    def output(self):
+        return {key: TerraformOutput(self, key) for key in self.props.output or []}
+
+    def get_output(self, key):
+        name = self.address.split(".", 1)[1]
+        return self.workspace.get_output(f"{name}__{key}")
+
+    def refresh(self):
+        return self.workspace.result_for(self, [self.workspace.refresh()])
+
+    def deploy(self, dry_run=False):
+        if dry_run:
+            result = self.workspace.result_for(self, [self.workspace.plan()])
+
+        else:
+            self.workspace.apply()
+            result = self.workspace.result_for(self, self.workspace._results)
+
+        error = self.workspace._missing.get(self.address)
+        if error is not None:
+            raise error
+
+        return result
+
+    def destroy(self, dry_run=False):
+        self.workspace._destroyed.add(self)
+        return self.deploy(dry_run=dry_run)
+
+    def import_resource(self, resource_id):
+        self.workspace._init(self.workspace.config(self.workspace.render()))
+        return self.workspace.run("import", self.address, evaluate(resource_id))